@@ -30,6 +30,7 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 import numpy as np
+import hashlib
 import itertools
 import numbers
 import multiprocessing as mp
@@ -39,6 +40,17 @@ from sklearn.utils.validation import check_array, check_is_fitted
 from sklearn.base import BaseEstimator
 from abc import ABC, abstractmethod
 
+# private scikit-learn module, renamed between releases: see get_nn_argkmin
+try:  # scikit-learn >= 1.2
+    from sklearn.metrics._pairwise_distances_reduction import ArgKmin
+except ImportError:
+    try:  # scikit-learn 1.1
+        from sklearn.metrics._pairwise_distances_reduction import (
+            PairwiseDistancesArgKmin as ArgKmin,
+        )
+    except ImportError:
+        ArgKmin = None
+
 
 def indComb(NN):
     pt1 = np.tile(range(NN), NN)
@@ -86,6 +98,12 @@ def lens(vectors):
     return np.sqrt(np.sum(vectors ** 2, axis=1))
 
 
+def _smooth_pw(dimension_pw, knnidx):
+    """Average each pointwise estimate with those of its k nearest neighbors"""
+    neighbor_ids = np.concatenate([np.arange(len(knnidx))[:, None], knnidx], axis=1)
+    return dimension_pw[neighbor_ids].mean(axis=1)
+
+
 def proxy(tup):
     function, X, Dict = tup
     return function(X, **Dict)
@@ -99,6 +117,78 @@ def get_nn(X, k, n_jobs=1):
     return dists, inds
 
 
+def get_nn_argkmin(X, k, n_jobs=1, squared=False):
+    """Compute the k-nearest neighbors of a dataset np.array (n_samples x n_dims),
+    as get_nn. With squared=True, squared distances are returned: for data with more
+    than 15 features they are computed by the argkmin kernel of scikit-learn >= 1.1
+    without taking square roots. This is the only case that differs from get_nn,
+    which already uses the same kernel through brute-force NearestNeighbors; the
+    kernel lives in a private scikit-learn module, so get_nn is used whenever it
+    cannot be imported"""
+    if (
+        not squared
+        or ArgKmin is None
+        or X.shape[1] <= 15
+        or not ArgKmin.is_usable_for(X, X, metric="sqeuclidean")
+    ):
+        dists, inds = get_nn(X, k=k, n_jobs=n_jobs)
+        return (dists * dists if squared else dists), inds
+
+    dists, inds = ArgKmin.compute(
+        X,
+        X,
+        k=k + 1,
+        metric="sqeuclidean",
+        strategy="parallel_on_X",
+        return_distance=True,
+    )
+    # drop each point from its own neighbors (or one of its duplicates if they
+    # crowded it out), as NearestNeighbors.kneighbors does
+    not_self = inds != np.arange(len(X))[:, None]
+    not_self[np.all(not_self, axis=1), 0] = False
+    return (
+        dists[not_self].reshape(len(X), k),
+        inds[not_self].reshape(len(X), k),
+    )
+
+
+_nn_cache = {}
+
+
+def get_nn_cached(nn_func, X, k, n_jobs=1, **kwargs):
+    """Call nn_func (get_nn or get_nn_argkmin) on X, reusing the result of the previous
+    call when X (compared by content), k and the other arguments are unchanged.
+
+    Only the most recent result is kept: it is evicted by the next call with different
+    inputs, or by clear_nn_cache. The returned arrays are shared between calls and
+    therefore read-only."""
+    X = np.ascontiguousarray(X)
+    key = (
+        nn_func.__name__,
+        k,
+        tuple(sorted(kwargs.items())),
+        X.shape,
+        X.dtype.str,
+        hashlib.blake2b(X, digest_size=16).hexdigest(),
+    )
+    # a single lookup, as another thread may evict the entry at any time
+    cached = _nn_cache.get(key)
+    if cached is not None:
+        return cached
+
+    dists, inds = nn_func(X, k=k, n_jobs=n_jobs, **kwargs)
+    dists.setflags(write=False)
+    inds.setflags(write=False)
+    _nn_cache.clear()
+    _nn_cache[key] = dists, inds
+    return dists, inds
+
+
+def clear_nn_cache():
+    """Release the kNN arrays kept by get_nn_cached"""
+    _nn_cache.clear()
+
+
 def asPointwise(data, class_instance, precomputed_knn=None, n_neighbors=100, n_jobs=1):
     """Use a global estimator as a pointwise one by creating kNN neighborhoods"""
     if precomputed_knn is not None:
@@ -193,11 +283,7 @@ class GlobalEstimator(ABC, BaseEstimator):
             )
 
         if smooth:
-            self.dimension_pw_smooth_ = np.zeros(len(knnidx))
-            for i, point_nn in enumerate(knnidx):
-                self.dimension_pw_smooth_[i] = np.mean(
-                    np.append(self.dimension_pw_[i], self.dimension_pw_[point_nn])
-                )
+            self.dimension_pw_smooth_ = _smooth_pw(self.dimension_pw_, knnidx)
         return self
 
     def predict_pw(self, X=None):
@@ -274,11 +360,7 @@ class GlobalEstimator(ABC, BaseEstimator):
             dimension_pw_ = np.array([self.fit(X[i, :]).dimension_ for i in knnidx])
 
         if smooth:
-            dimension_pw_smooth_ = np.zeros(len(knnidx))
-            for i, point_nn in enumerate(knnidx):
-                dimension_pw_smooth_[i] = np.mean(
-                    np.append(dimension_pw_[i], dimension_pw_[point_nn])
-                )
+            dimension_pw_smooth_ = _smooth_pw(dimension_pw_, knnidx)
             return dimension_pw_, dimension_pw_smooth_
         else:
             return dimension_pw_
@@ -361,11 +443,7 @@ class LocalEstimator(ABC, BaseEstimator):
 
         # compute smoothed local estimates
         if smooth:
-            self.dimension_pw_smooth_ = np.zeros(len(knnidx))
-            for i, point_nn in enumerate(knnidx):
-                self.dimension_pw_smooth_[i] = np.mean(
-                    np.append(self.dimension_pw_[i], self.dimension_pw_[point_nn])
-                )
+            self.dimension_pw_smooth_ = _smooth_pw(self.dimension_pw_, knnidx)
             self.is_fitted_pw_smooth_ = True
         self.is_fitted_pw_ = True
         self.is_fitted_ = True
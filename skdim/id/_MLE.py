@@ -29,13 +29,83 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
-import inspect
+import multiprocessing as mp
+import functools
+import pickle
+import warnings
+import numba as nb
 import scipy.integrate
 import numpy as np
-from .._commonfuncs import lens, get_nn, LocalEstimator
+from math import exp, log, pi, sqrt
+from scipy import LowLevelCallable
+from .._commonfuncs import (
+    lens,
+    get_nn,
+    get_nn_argkmin,
+    get_nn_cached,
+    _smooth_pw,
+    LocalEstimator,
+)
 from sklearn.utils.validation import check_array
 
 
+# Gauss-Legendre rule for custom transition densities, stored in float32 like the
+# integrands it is applied to and composed over at most 2 * _GL_MAX_PANELS + 1
+# panels; pointwise estimates are computed in chunks of about _GL_CHUNK_SIZE
+# integrand evaluations per panel
+_GL_NODES, _GL_WEIGHTS = np.polynomial.legendre.leggauss(32)
+_GL_NODES, _GL_WEIGHTS = _GL_NODES.astype(np.float32), _GL_WEIGHTS.astype(np.float32)
+_GL_MAX_PANELS = 64
+_GL_CHUNK_SIZE = 2 ** 16
+
+_quad_sig = nb.types.float64(nb.types.intc, nb.types.CPointer(nb.types.float64))
+
+
+@nb.cfunc(_quad_sig, cache=True)
+def _gaussH_denom_integrand(n, xx):
+    # xx = (x, Rj, 1 / sigma, 1 / (sigma * sqrt(2 * pi))):
+    # compiled MLE._dnoiseGaussH(x, Rj, sigma)
+    return xx[3] * exp(-0.5 * ((xx[1] - xx[0]) * xx[2]) ** 2)
+
+
+@nb.cfunc(_quad_sig, cache=True)
+def _gaussH_num_integrand(n, xx):
+    # xx = (x, Rj, 1 / sigma, 1 / (sigma * sqrt(2 * pi)), log(Rk)):
+    # compiled MLE._dnoiseGaussH(x, Rj, sigma) * log(Rk / x)
+    return xx[3] * exp(-0.5 * ((xx[1] - xx[0]) * xx[2]) ** 2) * (xx[4] - log(xx[0]))
+
+
+_gaussH_denom_llc = LowLevelCallable(_gaussH_denom_integrand.ctypes)
+_gaussH_num_llc = LowLevelCallable(_gaussH_num_integrand.ctypes)
+
+
+def _r_times_dnoise(dnoise, r, s, sigma, k):
+    # r * dnoise, the integrand weight used by 'guaranteed.convergence'
+    return r * dnoise(r, s, sigma, k)
+
+
+# numpy error model and no nnan/ninf fast-math flags: a zero distance (duplicate
+# points) gives an estimate of 0 and equidistant neighbors give inf, as with numpy
+@nb.njit(
+    fastmath={"nsz", "arcp", "contract", "reassoc"}, error_model="numpy", cache=True
+)
+def _mle_pointwise_nonoise(dists, unbiased, squared):
+    # closed-form Levina-Bickel estimate for each row of sorted kNN distances;
+    # with squared distances, log(Rk / Rj) = 0.5 * log(Rk**2 / Rj**2)
+    n_points, k = dists.shape
+    kfac = k - 2 if unbiased else k - 1
+    if squared:
+        kfac *= 2
+    de = np.empty(n_points)
+    for i in range(n_points):
+        Rk = dists[i, k - 1]
+        s = 0.0
+        for j in range(k - 1):
+            s += log(Rk / dists[i, j])
+        de[i] = kfac / s
+    return de
+
+
 class MLE(LocalEstimator):
     """ Intrinsic dimension estimation using the Maximum Likelihood algorithm. 
 
@@ -94,12 +164,13 @@ class MLE(LocalEstimator):
         neighborhood_based=True,
         K=5,
     ):
-
-        _, _, _, values = inspect.getargvalues(inspect.currentframe())
-        values.pop("self")
-
-        for arg, val in values.items():
-            setattr(self, arg, val)
+        self.dnoise = dnoise
+        self.sigma = sigma
+        self.n = n
+        self.integral_approximation = integral_approximation
+        self.unbiased = unbiased
+        self.neighborhood_based = neighborhood_based
+        self.K = K
 
     def fit(
         self,
@@ -148,24 +219,41 @@ class MLE(LocalEstimator):
         X = check_array(
             X, ensure_min_samples=self.n_neighbors + 1, ensure_min_features=2
         )
+        self._resolve_dnoise()
 
+        # the noise-free pointwise estimate only depends on distance ratios, so it
+        # works on squared distances; Rs enters dnoise and must stay unsquared
+        squared = False
         if precomputed_knn_arrays is not None:
             dists, knnidx = precomputed_knn_arrays
         else:
             if self.neighborhood_based:
-                dists, knnidx = get_nn(X, k=self.n_neighbors, n_jobs=n_jobs)
+                squared = self.dnoise is None
+                dists, knnidx = get_nn_cached(
+                    get_nn_argkmin,
+                    X,
+                    k=self.n_neighbors,
+                    n_jobs=n_jobs,
+                    squared=squared,
+                )
             else:
-                dists, knnidx = get_nn(X, k=self.K, n_jobs=n_jobs)
+                # exact distances: the global estimate deduplicates d(i, j) and
+                # d(j, i), which the GEMM-based kernel does not round identically
+                dists, knnidx = get_nn_cached(get_nn, X, k=self.K, n_jobs=n_jobs)
 
         if self.neighborhood_based:
-            self.dimension_pw_ = self._maxLikPointwiseDimEst(dists)
+            self.dimension_pw_ = self._maxLikPointwiseDimEst(
+                dists, squared=squared, n_jobs=n_jobs
+            )
             # combine local estimates
             if self.comb == "mean":
                 self.dimension_ = np.mean(self.dimension_pw_)
             elif self.comb == "median":
                 self.dimension_ = np.median(self.dimension_pw_)
             elif self.comb == "mle":
-                self.dimension_ = 1 / np.mean(1 / self.dimension_pw_)
+                self.dimension_ = (
+                    self.dimension_pw_.size / np.reciprocal(self.dimension_pw_).sum()
+                )
             else:
                 raise ValueError(
                     "Invalid comb parameter. It has to be 'mean' or 'median'"
@@ -173,18 +261,12 @@ class MLE(LocalEstimator):
 
             # compute smoothed local estimates
             if smooth:
-                self.dimension_pw_smooth_ = np.zeros(len(knnidx))
-                for i, point_nn in enumerate(knnidx):
-                    self.dimension_pw_smooth_[i] = np.mean(
-                        np.append(self.dimension_pw_[i], self.dimension_pw_[point_nn])
-                    )
+                self.dimension_pw_smooth_ = _smooth_pw(self.dimension_pw_, knnidx)
                 self.is_fitted_pw_smooth_ = True
             self.is_fitted_pw_ = True
 
         else:
-            Rs = np.sort(np.array(list(set(dists.flatten(order="F")))))[
-                : self.n_neighbors
-            ]
+            Rs = np.unique(dists)[: self.n_neighbors]
             # Since distances between points are used, noise is
             self.dimension_ = self._fit(Rs, np.sqrt(2) * self.sigma)
             # added at both ends, i.e. variance is doubled.
@@ -235,7 +317,7 @@ class MLE(LocalEstimator):
             n_jobs=n_jobs,
         ).dimension_
 
-    def _maxLikPointwiseDimEst(self, dists):
+    def _maxLikPointwiseDimEst(self, dists, squared=False, n_jobs=1):
         # estimates dimension around each point in data[indices, ]
         #
         # 'indices' give the indexes for which local dimension estimation should
@@ -244,85 +326,210 @@ class MLE(LocalEstimator):
         # 'dnoise' is a vector valued function giving the transition density.
         # 'sigma' is the estimated standard deviation for the noise.
         # 'n' is the dimension of the noise (at least dim(data)[2])
+        # 'squared' means dists holds squared distances (only used without dnoise)
+        # 'n_jobs' is the number of processes used with dnoise
 
-        # This vector will hold local dimension estimates
-        de = np.repeat(np.nan, len(dists))
-
-        for i in range(len(dists)):
-            Rs = dists[i, :]
-            de[i] = self._fit(Rs, self.sigma)
+        if self.dnoise is None:
+            # closed-form Levina-Bickel estimate, computed for all points at once
+            # (dists rows are sorted so the last column holds Rk)
+            return _mle_pointwise_nonoise(
+                np.ascontiguousarray(dists, dtype=np.float64), self.unbiased, squared
+            )
 
-        return de
+        # negative n_jobs counts back from the number of CPUs, as in scikit-learn
+        if n_jobs < 0:
+            n_jobs = mp.cpu_count() + 1 + n_jobs
+        n_jobs = max(n_jobs, 1)
+
+        # estimate a chunk of points per call, small enough for the quadrature
+        # arrays built from it to stay in cache (and at least one per process)
+        dists = np.asarray(dists)
+        chunk_size = max(1, _GL_CHUNK_SIZE // (len(_GL_NODES) * dists.shape[1]))
+        if n_jobs > 1:
+            chunk_size = min(chunk_size, -(-len(dists) // n_jobs))
+        chunks = [
+            (dists[i : i + chunk_size], self.sigma)
+            for i in range(0, len(dists), chunk_size)
+        ]
+
+        if n_jobs > 1:
+            # chunks are sent to the workers with the estimator, which cannot be
+            # pickled when dnoise is a lambda or a locally defined function
+            try:
+                pickle.dumps(self)
+            except (pickle.PicklingError, AttributeError, TypeError):
+                warnings.warn(
+                    "dnoise cannot be pickled, estimating pointwise dimensions "
+                    "with n_jobs=1"
+                )
+                n_jobs = 1
+        if n_jobs > 1:
+            with mp.Pool(n_jobs) as pool:
+                results = pool.starmap(self._fit, chunks)
+        else:
+            results = [self._fit(*chunk) for chunk in chunks]
+        return np.concatenate(results)
 
     def _fit_once(self, X):
         # assuming data set is local
         center = np.mean(X, axis=0)
         cent_X = X - center
         Rs = np.sort(lens(cent_X))
+        self._resolve_dnoise()
         de = self._fit(Rs, self.sigma)
         return de
 
-    def _fit(self, Rs, sigma):
-        """ fit maxLikDimEstFromR """
+    def _resolve_dnoise(self):
+        # validate integral_approximation and resolve dnoise once per fit, so
+        # that _fit (called once per chunk of points) only dispatches on it.
+        # self.dnoise is a user parameter and is left as is
         if self.integral_approximation not in [
             "Haro",
             "guaranteed.convergence",
             "iteration",
         ]:
             raise ValueError("Unknown integral_approximation parameter")
-
-        if self.dnoise == "dnoiseGaussH":
-            self.dnoise = self._dnoiseGaussH
-
-        if not self.integral_approximation == "Haro" and self.dnoise is not None:
-            self.dnoise = lambda r, s, sigma, k: r * self.dnoise(r, s, sigma, k)
-
-        de = self._maxLikDimEstFromR_haro_approx(Rs, self.sigma)
         if self.integral_approximation == "iteration":
             raise ValueError(
                 "integral_approximation='iteration' not implemented yet. See R intrinsicDimension package"
             )
             # de = maxLikDimEstFromRIterative(Rs, dnoise_orig, sigma, n, de, unbiased)
 
-        return de
+        if self.dnoise == "dnoiseGaussH":
+            dnoise = self._dnoiseGaussH
+        else:
+            dnoise = self.dnoise
+
+        if not self.integral_approximation == "Haro" and dnoise is not None:
+            # partial rather than a closure, so the estimator can still be pickled
+            dnoise = functools.partial(_r_times_dnoise, dnoise)
+
+        self._dnoise_resolved = dnoise
+
+    def _fit(self, Rs, sigma):
+        """ fit maxLikDimEstFromR """
+        if self._dnoise_resolved is self._dnoiseGaussH:
+            return self._maxLikDimEstFromR_gaussH(Rs, self.sigma)
+        return self._maxLikDimEstFromR_haro_approx(Rs, self.sigma)
 
     def _maxLikDimEstFromR_haro_approx(self, Rs, sigma):
         # if dnoise is the noise function this is the approximation used in Haro.
         # for 'guaranteed.convergence' dnoise should be r times the noise function
         # with 'unbiased' option, estimator is unbiased if no noise or boundary
+        # Rs must be sorted in ascending order (as returned by get_nn); a
+        # (n_points x k) array of such rows gives one estimate per row
 
-        k = len(Rs)
+        dnoise = self._dnoise_resolved
+        k = Rs.shape[-1]
         kfac = k - 2 if self.unbiased else k - 1
 
-        Rk = np.max(Rs)
-        if self.dnoise is None:
-            return kfac / (np.sum(np.log(Rk / Rs)))
-
+        assert np.all(Rs[..., 0] <= Rs[..., -1]), "Rs must be sorted in ascending order"
+        if dnoise is None:
+            return kfac / np.sum(np.log(Rs[..., -1:] / Rs), axis=-1)
+
+        # Gauss-Legendre rule composed over [0, Rpr], split at the window
+        # [Rj - 8 sigma, Rj + 8 sigma] (clipped at 0) around each neighbor distance Rj.
+        # The integrands are evaluated in float32, which is ample for the 1e-2
+        # accuracy needed here and halves memory traffic; the final sum is float64
+        Rs = Rs.astype(np.float32)
+        sigma = np.float32(sigma)
+        Rj = Rs[..., None, :-1]
+        Rk = Rs[..., None, -1:]
         Rpr = Rk + 100 * sigma
+        lo = np.maximum(Rj - 8 * sigma, 0)
+        hi = Rj + 8 * sigma
+
+        # the segments on either side of the window are split into panels no wider
+        # than the window, so that densities peaking away from Rj are resolved too.
+        # The panel count is chosen for each Rj, so that estimates do not depend on
+        # the chunk of points they are computed with: Rj needing fewer panels than
+        # others in the chunk get zero-width ones
+        panels = [(lo, hi)]
+        for a, b in [(0, lo), (hi, Rpr)]:
+            n_panels = np.clip(np.ceil((b - a) / (16 * sigma)), 1, _GL_MAX_PANELS)
+            width = (b - a) / n_panels
+            panels += [
+                (
+                    np.where(i < n_panels, a + i * width, b),
+                    np.where(i < n_panels, a + (i + 1) * width, b),
+                )
+                for i in range(int(n_panels.max()))
+            ]
+
+        numerator = np.zeros(Rj.shape[:-2] + Rj.shape[-1:])
+        denominator = np.zeros_like(numerator)
+        # panels left of the window have zero width when Rj < 8 sigma
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for a, b in panels:
+                half_width = (b - a) / 2
+                # x[..., m, j] holds the m-th node of the panel for Rj
+                x = a + (_GL_NODES[:, None] + 1) * half_width
+                D = dnoise(x, Rj, sigma, self.n)
+                num = np.einsum("m,...mj->...j", _GL_WEIGHTS, D * np.log(Rk / x))
+                den = np.einsum("m,...mj->...j", _GL_WEIGHTS, D)
+                half_width = half_width[..., 0, :]
+                numerator += np.where(half_width > 0, half_width * num, 0)
+                denominator += np.where(half_width > 0, half_width * den, 0)
+
+        # a Rj for which dnoise has no mass on [0, Rpr] carries no information
+        ratio = np.divide(
+            numerator,
+            denominator,
+            out=np.zeros_like(numerator),
+            where=denominator > 0,
+        )
+        return kfac / np.sum(ratio, axis=-1)
+
+    def _maxLikDimEstFromR_gaussH(self, Rs, sigma):
+        # same as _maxLikDimEstFromR_haro_approx with dnoise = _dnoiseGaussH,
+        # but quad calls compiled integrands instead of Python callbacks
+
+        if Rs.ndim == 2:
+            return np.array([self._maxLikDimEstFromR_gaussH(R, sigma) for R in Rs])
+
+        k = len(Rs)
+        kfac = k - 2 if self.unbiased else k - 1
 
-        numerator = np.repeat(np.nan, k - 1)
-        denominator = np.repeat(np.nan, k - 1)
+        assert Rs[0] <= Rs[-1], "Rs must be sorted in ascending order"
+        Rk = Rs[-1]
 
-        def numInt(x):
-            return self.dnoise(x, Rj, sigma, self.n) * np.log(Rk / x)
+        # integrand parameters that do not depend on x or Rj
+        inv_sigma = 1 / sigma
+        norm = 1 / (sigma * np.sqrt(2 * np.pi))
+        log_Rk = np.log(Rk)
 
-        def denomInt(x):
-            return self.dnoise(x, Rj, sigma, self.n)
+        numerator = np.empty(k - 1, dtype=np.float64)
+        denominator = np.empty(k - 1, dtype=np.float64)
 
+        # integrate over [Rj - 8 sigma, Rj + 8 sigma] (clipped at 0) rather than
+        # [0, Rk + 100 sigma]: the Gaussian mass outside is below 1e-14, and quad
+        # no longer spends subdivisions on the empty tails
         for j in range(k - 1):
             Rj = Rs[j]
+            lo = max(Rj - 8 * sigma, 0)
+            hi = Rj + 8 * sigma
             numerator[j] = scipy.integrate.quad(
-                numInt, 0, Rpr, epsrel=1e-2, epsabs=1e-2
+                _gaussH_num_llc,
+                lo,
+                hi,
+                args=(Rj, inv_sigma, norm, log_Rk),
+                epsrel=1e-2,
+                epsabs=1e-2,
             )[0]
             denominator[j] = scipy.integrate.quad(
-                denomInt, 0, Rpr, epsrel=1e-2, epsabs=1e-2
+                _gaussH_denom_llc,
+                lo,
+                hi,
+                args=(Rj, inv_sigma, norm),
+                epsrel=1e-2,
+                epsabs=1e-2,
             )[0]
 
         return kfac / np.sum(numerator / denominator)
 
     @staticmethod
     def _dnoiseGaussH(r, s, sigma, k=None):
-        return np.exp(-0.5 * ((s - r) / sigma) ** 2) / (sigma * np.sqrt(2 * np.pi))
+        return np.exp(-0.5 * ((s - r) / sigma) ** 2) / (sigma * sqrt(2 * pi))
         # f(s|r) in Haro et al. (2008) w/ Gaussian
         # transition density
         # 'k' is not used, but is input
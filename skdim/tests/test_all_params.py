@@ -34,7 +34,9 @@ import numpy as np
 import skdim
 import matplotlib.pyplot as plt
 from inspect import getmembers, isclass
+from scipy.integrate import quad
 from sklearn.utils.estimator_checks import check_estimator
+from skdim._commonfuncs import get_nn, get_nn_argkmin, get_nn_cached
 
 
 @pytest.fixture
@@ -138,6 +140,173 @@ def test_mle_params(data):
     x = skdim.id.MLE(neighborhood_aggregation="median").fit(data)
 
 
+def test_mle_guaranteed_convergence(data):
+    x = skdim.id.MLE(
+        sigma=0.1,
+        dnoise="dnoiseGaussH",
+        integral_approximation="guaranteed.convergence",
+    )
+    dim = x.fit(data).dimension_
+    # dnoise is not overwritten, so refitting gives the same estimate
+    assert x.dnoise == "dnoiseGaussH"
+    assert x.fit(data).dimension_ == dim
+
+
+def _mle_pw_reference(dists, dnoise=None, sigma=None, n=None):
+    # pointwise MLE of Haro et al. (2008) with scipy.integrate.quad over
+    # [0, Rk + 100 sigma], split at Rj and at the peak of shifted_dnoise
+    kfac = dists.shape[1] - 1
+    pw = []
+    for Rs in dists:
+        Rk = Rs[-1]
+        if dnoise is None:
+            pw.append(kfac / np.sum(np.log(Rk / Rs)))
+            continue
+        Rpr = Rk + 100 * sigma
+        ratio = 0
+        for Rj in Rs[:-1]:
+            points = [Rj, np.sqrt(Rj ** 2 + 2 * n * sigma ** 2)]
+            kwargs = dict(points=points, limit=200, epsabs=0, epsrel=1e-8)
+            num = quad(
+                lambda x: dnoise(x, Rj, sigma, n) * np.log(Rk / x), 0, Rpr, **kwargs
+            )
+            den = quad(lambda x: dnoise(x, Rj, sigma, n), 0, Rpr, **kwargs)
+            ratio += num[0] / den[0]
+        pw.append(kfac / ratio)
+    return np.array(pw)
+
+
+def shifted_dnoise(r, s, sigma, n):
+    # transition density peaking away from s, at sqrt(s^2 + 2 n sigma^2)
+    return np.exp(-0.5 * ((r - np.sqrt(s ** 2 + 2 * n * sigma ** 2)) / sigma) ** 2)
+
+
+@pytest.fixture
+def mle_data():
+    # > 15 features so that squared distances come from the argkmin kernel
+    X = np.zeros((40, 20))
+    X[:, :5] = skdim.datasets.hyperBall(n=40, d=5, radius=1, random_state=0)
+    return X, get_nn(X, k=10)
+
+
+def test_mle_nonoise_pw(mle_data):
+    X, (dists, inds) = mle_data
+    ref = _mle_pw_reference(dists)
+    # fit searches neighbors with squared distances, precomputed ones are not squared
+    x = skdim.id.MLE().fit(X, n_neighbors=10)
+    np.testing.assert_allclose(x.dimension_pw_, ref, rtol=1e-10)
+    x = skdim.id.MLE().fit(X, precomputed_knn_arrays=(dists, inds), n_neighbors=10)
+    np.testing.assert_allclose(x.dimension_pw_, ref, rtol=1e-10)
+
+
+@pytest.mark.parametrize("n_features", [10, 20])
+def test_mle_nonoise_pw_degenerate(n_features):
+    # duplicated points give zero distances, a grid gives equidistant neighbors;
+    # with > 15 features, fit uses squared distances from the argkmin kernel
+    X = np.zeros((60, n_features))
+    X[:, :5] = skdim.datasets.hyperBall(n=60, d=5, radius=1, random_state=0)
+    X[30:40] = X[:10]
+    grid = np.stack(np.meshgrid(np.arange(10.0), np.arange(10.0)), -1).reshape(-1, 2)
+    for X, n_neighbors in [(X, 10), (grid, 4)]:
+        dists, _ = get_nn(X, k=n_neighbors)
+        with np.errstate(divide="ignore"):
+            ref = _mle_pw_reference(dists)
+        x = skdim.id.MLE().fit(X, n_neighbors=n_neighbors)
+        np.testing.assert_allclose(x.dimension_pw_, ref, rtol=1e-10)
+
+
+@pytest.mark.parametrize(
+    "dnoise,integral_approximation,n",
+    [
+        ("dnoiseGaussH", "Haro", 1),
+        ("dnoiseGaussH", "guaranteed.convergence", 1),
+        (shifted_dnoise, "Haro", 50),
+        (shifted_dnoise, "guaranteed.convergence", 50),
+    ],
+)
+def test_mle_noise_pw(mle_data, dnoise, integral_approximation, n):
+    X, (dists, inds) = mle_data
+    x = skdim.id.MLE(
+        dnoise=dnoise, sigma=0.05, n=n, integral_approximation=integral_approximation
+    ).fit(X, n_neighbors=10)
+    if dnoise == "dnoiseGaussH":
+        dnoise = skdim.id.MLE._dnoiseGaussH
+    if integral_approximation == "guaranteed.convergence":
+        ref = _mle_pw_reference(
+            dists, lambda r, s, sigma, n: r * dnoise(r, s, sigma, n), sigma=0.05, n=n
+        )
+    else:
+        ref = _mle_pw_reference(dists, dnoise, sigma=0.05, n=n)
+    np.testing.assert_allclose(x.dimension_pw_, ref, rtol=1e-3)
+
+
+@pytest.mark.parametrize("dnoise", ["dnoiseGaussH", shifted_dnoise])
+def test_mle_n_jobs(dnoise):
+    # n_jobs changes how points are chunked, but not the estimates; points at two
+    # scales so that chunks need different numbers of quadrature panels
+    X = skdim.datasets.hyperBall(n=200, d=5, radius=1, random_state=0)
+    X[100:] *= 5
+    x = skdim.id.MLE(dnoise=dnoise, sigma=0.05, n=5)
+    dimension_pw = x.fit(X, n_neighbors=10).dimension_pw_
+    for n_jobs in [2, -1]:
+        x.fit(X, n_neighbors=10, n_jobs=n_jobs)
+        np.testing.assert_array_equal(x.dimension_pw_, dimension_pw)
+
+
+def test_mle_n_jobs_unpicklable_dnoise():
+    X = skdim.datasets.hyperBall(n=200, d=5, radius=1, random_state=0)
+    x = skdim.id.MLE(
+        dnoise=lambda r, s, sigma, n: shifted_dnoise(r, s, sigma, n), sigma=0.05, n=5
+    )
+    dimension_pw = x.fit(X, n_neighbors=10).dimension_pw_
+    with pytest.warns(UserWarning, match="cannot be pickled"):
+        x.fit(X, n_neighbors=10, n_jobs=2)
+    np.testing.assert_array_equal(x.dimension_pw_, dimension_pw)
+
+
+def test_get_nn_argkmin():
+    # > 15 features to use the argkmin kernel, and more copies of X[0] than
+    # neighbors so that some points are crowded out of their own neighbors
+    X = np.random.RandomState(0).rand(60, 20)
+    X[:15] = X[0]
+    dists, inds = get_nn_argkmin(X, k=10, squared=True)
+    ref_dists, ref_inds = get_nn(X, k=10)
+    assert dists.shape == inds.shape == (60, 10)
+    assert not np.any(inds == np.arange(60)[:, None])
+    np.testing.assert_allclose(dists, ref_dists ** 2, rtol=1e-6, atol=1e-8)
+    # copies of X[0] tie, so neighbors are compared by coordinates
+    np.testing.assert_array_equal(X[inds], X[ref_inds])
+    dists, inds = get_nn_argkmin(X, k=10)
+    np.testing.assert_array_equal(dists, ref_dists)
+
+
+def test_nn_cache():
+    X = skdim.datasets.hyperBall(n=100, d=5, radius=1, random_state=0)
+    skdim.clear_nn_cache()
+    x = skdim.id.MLE().fit(X, n_neighbors=10)
+    (cached,) = skdim._commonfuncs._nn_cache.values()
+    # a refit on identical data reuses the cached arrays
+    dimension_pw = x.dimension_pw_
+    x.fit(X.copy(), n_neighbors=10)
+    (refit_cached,) = skdim._commonfuncs._nn_cache.values()
+    assert refit_cached is cached
+    np.testing.assert_array_equal(x.dimension_pw_, dimension_pw)
+
+    dists, inds = get_nn_cached(get_nn_argkmin, X, k=10, squared=True)
+    assert dists is cached[0] and inds is cached[1]
+    assert not dists.flags.writeable and not inds.flags.writeable
+    # other k, squared or data content miss the cache
+    assert get_nn_cached(get_nn_argkmin, X, k=5, squared=True)[0] is not dists
+    dists = get_nn_cached(get_nn_argkmin, X, k=10, squared=True)[0]
+    assert get_nn_cached(get_nn_argkmin, X, k=10)[0] is not dists
+    dists = get_nn_cached(get_nn_argkmin, X, k=10)[0]
+    X[0, 0] += 1
+    assert get_nn_cached(get_nn_argkmin, X, k=10)[0] is not dists
+
+    skdim.clear_nn_cache()
+    assert not skdim._commonfuncs._nn_cache
+
+
 def test_twonn_params(data):
     # to trigger the "n_features>25 condition"
     test_high_dim = np.zeros((len(data), 30))